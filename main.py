@@ -1,8 +1,40 @@
+import hashlib
+import io
+import itertools
+import logging
+import os
+import shutil
+import tempfile
+import time
+import numpy as np
+import orjson
 import streamlit as st
 import pandas as pd
-import plotly.express as px
+import plotly.graph_objects as go
+import torch
 from transformers import pipeline
 
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+try:
+    import polars as pl
+except ImportError:
+    pl = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
 # Set page configuration for wide layout
 st.set_page_config(
     page_title="Spotify Listener Dashboard",
@@ -10,8 +42,91 @@ st.set_page_config(
     initial_sidebar_state="collapsed",
 )
 
-# Initialize RoBERTa QA Model
-qa_model = pipeline("question-answering", model="deepset/roberta-base-squad2")
+QA_MODEL_NAME = "deepset/roberta-base-squad2"
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "spotify-dashboard")
+QUANTIZED_MODEL_DIR = os.path.join(CACHE_DIR, "roberta-squad2-int8")
+QUANTIZED_MODEL_FILES = ("model_quantized.onnx", "config.json", "tokenizer_config.json")
+
+# Bump whenever the loading/cleaning logic changes so stale cached frames are never served
+CLEANED_CACHE_VERSION = 2
+CLEANED_CACHE_PREFIX = f"cleaned-v{CLEANED_CACHE_VERSION}-"
+# Cached frames hold private listening history, so bound how long and how much is kept
+CLEANED_CACHE_MAX_AGE_SECONDS = 7 * 24 * 60 * 60
+CLEANED_CACHE_MAX_BYTES = 500 * 1024 * 1024
+
+logger = logging.getLogger(__name__)
+
+def quantized_model_is_complete(model_dir):
+    """
+    Returns True if model_dir holds a finished export (quantized model, config and tokenizer).
+    """
+    return all(os.path.isfile(os.path.join(model_dir, name)) for name in QUANTIZED_MODEL_FILES)
+
+def export_quantized_qa_model():
+    """
+    Exports and quantizes the QA model into a temporary directory, then renames it
+    into place so a failed export never leaves a half-written QUANTIZED_MODEL_DIR.
+    """
+    from optimum.onnxruntime import ORTModelForQuestionAnswering, ORTQuantizer
+    from optimum.onnxruntime.configuration import AutoQuantizationConfig
+    from transformers import AutoTokenizer
+
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(dir=CACHE_DIR, prefix="roberta-squad2-int8-")
+    try:
+        onnx_model = ORTModelForQuestionAnswering.from_pretrained(QA_MODEL_NAME, export=True)
+        quantizer = ORTQuantizer.from_pretrained(onnx_model)
+        quantizer.quantize(
+            save_dir=tmp_dir,
+            quantization_config=AutoQuantizationConfig.avx512_vnni(is_static=False, per_channel=False),
+        )
+        onnx_model.config.save_pretrained(tmp_dir)
+        AutoTokenizer.from_pretrained(QA_MODEL_NAME).save_pretrained(tmp_dir)
+
+        # Replace a stale, incomplete export left behind by older runs
+        if os.path.isdir(QUANTIZED_MODEL_DIR) and not quantized_model_is_complete(QUANTIZED_MODEL_DIR):
+            shutil.rmtree(QUANTIZED_MODEL_DIR, ignore_errors=True)
+        try:
+            os.replace(tmp_dir, QUANTIZED_MODEL_DIR)
+        except OSError:
+            # Another process finished its export first
+            if not quantized_model_is_complete(QUANTIZED_MODEL_DIR):
+                raise
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+def load_quantized_qa_model():
+    """
+    Exports the QA model to ONNX and applies dynamic int8 quantization (done once,
+    then reused from disk). Returns None if optimum/onnxruntime are not available.
+    """
+    try:
+        from optimum.onnxruntime import ORTModelForQuestionAnswering
+        from transformers import AutoTokenizer
+    except ImportError:
+        return None
+
+    if not quantized_model_is_complete(QUANTIZED_MODEL_DIR):
+        export_quantized_qa_model()
+
+    model = ORTModelForQuestionAnswering.from_pretrained(QUANTIZED_MODEL_DIR, file_name="model_quantized.onnx")
+    tokenizer = AutoTokenizer.from_pretrained(QUANTIZED_MODEL_DIR)
+    return pipeline("question-answering", model=model, tokenizer=tokenizer)
+
+# Initialize RoBERTa QA Model (cached so Streamlit reruns reuse the loaded weights)
+@st.cache_resource(show_spinner=False)
+def get_qa_model():
+    try:
+        qa = load_quantized_qa_model()
+    except Exception:
+        logger.exception("Could not load the quantized QA model, falling back to FP32")
+        qa = None
+    if qa is None:
+        # Fall back to the plain FP32 transformers pipeline
+        qa = pipeline("question-answering", model=QA_MODEL_NAME)
+    return qa
+
+qa_model = get_qa_model()
 
 # App Title
 st.title("Spotify Listener Dashboard")
@@ -28,6 +143,11 @@ Follow these steps to request and download your data:
 5. Upload these files below to analyze your listening habits.
 """)
 
+DAY_OF_WEEK_DTYPE = pd.CategoricalDtype(
+    categories=['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday'],
+    ordered=True,
+)
+
 def detect_file_format(data):
     """
     Detect whether the uploaded JSON file is in the old or new format.
@@ -46,74 +166,583 @@ def detect_file_format(data):
 #     """
 #     return pd.DataFrame(data)
 
+FORMAT_FIELDS = {
+    "new": ("ts", "master_metadata_album_artist_name", "master_metadata_track_name", "ms_played"),
+    "old": ("endTime", "artistName", "trackName", "msPlayed"),
+}
+
+def read_json_columns(file_bytes):
+    """
+    Reads the records of an uploaded JSON file straight into per-field column lists,
+    keeping only the fields the dashboard uses. Records are streamed with ijson when
+    it is installed, so the full list of record dicts is never held in memory.
+    Returns the detected format and the columns (None for unknown formats).
+    """
+    if ijson is not None:
+        records = ijson.items(io.BytesIO(file_bytes), "item", use_float=True)
+    else:
+        records = iter(orjson.loads(file_bytes))
+
+    first_record = next(records, None)
+    if first_record is None:
+        return "unknown", None
+    file_format = detect_file_format([first_record])
+    if file_format == "unknown":
+        return file_format, None
+
+    fields = FORMAT_FIELDS[file_format]
+    columns = {field: [] for field in fields}
+    for record in itertools.chain([first_record], records):
+        for field in fields:
+            columns[field].append(record.get(field))
+    return file_format, columns
+
 def convert_new_format_to_old_format(new_data):
     """
     Converts new Spotify data format to the old format by extracting relevant columns
-    and reformatting the fields.
+    and reformatting the fields. Accepts a list of records or a dict of columns.
     """
-    converted_data = []
-    for record in new_data:
-        converted_data.append({
-            "endTime": pd.to_datetime(record["ts"]).strftime("%Y-%m-%d %H:%M"),  # Convert 'ts' to desired format
-            "artistName": record.get("master_metadata_album_artist_name", None),  # Artist name
-            "trackName": record.get("master_metadata_track_name", None),  # Track name
-            "msPlayed": record.get("ms_played", 0)  # Playtime in milliseconds
-        })
-    return pd.DataFrame(converted_data)
+    raw = pd.DataFrame(new_data)
+    ms_played = raw["ms_played"].fillna(0) if "ms_played" in raw else 0
+    return pd.DataFrame({
+        "endTime": pd.to_datetime(raw["ts"]).dt.tz_localize(None),  # Keep 'ts' as naive UTC datetime64
+        "artistName": raw.get("master_metadata_album_artist_name"),  # Artist name
+        "trackName": raw.get("master_metadata_track_name"),  # Track name
+        "msPlayed": ms_played  # Playtime in milliseconds
+    })
 
 
 
-# File Upload Section
-uploaded_files = st.file_uploader("Upload JSON File(s)", type="json", accept_multiple_files=True)
-
-# Ensure session state for the query response
-if "llm_response" not in st.session_state:
-    st.session_state.llm_response = ""
+def detect_polars_file_format(frame):
+    """
+    Detects the format of a frame read with POLARS_READ_SCHEMA from its first row,
+    since every field of both formats is present (possibly null) after the read.
+    Mirrors detect_file_format, so old-format podcast files (no trackName) are rejected.
+    """
+    if frame.height == 0:
+        return "unknown"
+    if frame["ts"][0] is not None:
+        return "new"
+    elif frame["endTime"][0] is not None and frame["trackName"][0] is not None:
+        return "old"
+    else:
+        return "unknown"
 
-if uploaded_files:
+def convert_polars_frame_to_old_format(frame, file_format):
+    """
+    Selects and normalizes the old-format columns from a polars frame of either format.
+    """
+    if file_format == "new":
+        ms_played = pl.col("ms_played").fill_null(0)
+        return frame.select(
+            pl.col("ts").str.to_datetime(time_zone="UTC").dt.replace_time_zone(None).dt.cast_time_unit("us").alias("endTime"),
+            pl.col("master_metadata_album_artist_name").cast(pl.Utf8).alias("artistName"),
+            pl.col("master_metadata_track_name").cast(pl.Utf8).alias("trackName"),
+            ms_played.cast(pl.Int64).alias("msPlayed"),
+        )
+    return frame.select(
+        pl.col("endTime").str.to_datetime("%Y-%m-%d %H:%M").dt.cast_time_unit("us"),
+        pl.col("artistName").cast(pl.Utf8),
+        pl.col("trackName").cast(pl.Utf8),
+        pl.col("msPlayed").cast(pl.Int64),
+    )
+
+if pl is not None:
+    POLARS_READ_SCHEMA = {
+        "ts": pl.Utf8,
+        "master_metadata_album_artist_name": pl.Utf8,
+        "master_metadata_track_name": pl.Utf8,
+        "ms_played": pl.Int64,
+        "endTime": pl.Utf8,
+        "artistName": pl.Utf8,
+        "trackName": pl.Utf8,
+        "msPlayed": pl.Int64,
+    }
+
+def clean_with_polars(file_bytes_tuple):
+    """
+    Parses, converts and cleans the uploaded files with polars' multithreaded
+    columnar engine, converting to pandas only at the end.
+    """
+    frames = []
+    skipped_files = 0
+    for file_bytes in file_bytes_tuple:
+        # An explicit schema projects only the fields we use, so nullable fields such as
+        # episode_name can never break schema inference
+        frame = pl.read_json(io.BytesIO(file_bytes), schema=POLARS_READ_SCHEMA)
+        file_format = detect_polars_file_format(frame)
+        if file_format == "unknown":
+            skipped_files += 1
+            continue
+        frames.append(convert_polars_frame_to_old_format(frame, file_format))
+
+    if not frames:
+        return None, skipped_files
+
+    df = (
+        pl.concat(frames)
+        .lazy()
+        .filter(pl.col("msPlayed") > 0)
+        .with_columns(
+            pl.col("msPlayed").cast(pl.Int32),
+            pl.col("endTime").dt.hour().cast(pl.Int32).alias("hour"),
+            pl.col("endTime").dt.strftime("%A").alias("day_of_week"),
+            (pl.col("msPlayed") / 60000).cast(pl.Float32).alias("duration_minutes"),
+            pl.col("endTime").dt.month().cast(pl.Int32).alias("month"),
+        )
+        .collect()
+        .to_pandas()
+    )
+    return df, skipped_files
+
+def clean_with_pandas(file_bytes_tuple):
+    """
+    Parses, converts and cleans the uploaded files with ijson (or orjson) and pandas.
+    """
     combined_data = []
-    for file in uploaded_files:
-        # Load the JSON data
-        file_data = pd.read_json(file).to_dict(orient="records")
-        
-        # Detect the format
-        file_format = detect_file_format(file_data)
+    skipped_files = 0
+    for file_bytes in file_bytes_tuple:
+        # Load the JSON data and detect the format
+        file_format, file_data = read_json_columns(file_bytes)
         if file_format == "old":
             converted_df = pd.DataFrame(file_data)
+            converted_df['endTime'] = pd.to_datetime(converted_df['endTime'])
         elif file_format == "new":
             converted_df = convert_new_format_to_old_format(file_data)
         else:
-            st.error("Unknown file format. Please upload valid Spotify data files.")
+            skipped_files += 1
             continue
-        
+
         combined_data.append(converted_df)
 
+    if not combined_data:
+        return None, skipped_files
+
     # Combine all converted data
-    if combined_data:
-        df = pd.concat(combined_data, ignore_index=True)
-        # st.write("Data successfully loaded and converted!")
-        # st.write(df.head())  # Preview the converted DataFrame
-    else:
-        st.error("No valid data to process. File conversion failed. Check the file formats")
+    df = pd.concat(combined_data, ignore_index=True)
 
     # Data Cleaning
-    df['endTime'] = pd.to_datetime(df['endTime'])
-    df = df[df['msPlayed'] > 0]
+    if df['endTime'].dtype.kind != 'M':
+        df['endTime'] = pd.to_datetime(df['endTime'])
+    df = df[df['msPlayed'] > 0].copy()
+    # Single plays are far below 2**31 ms, so the narrower dtypes are safe and halve bandwidth
+    df['msPlayed'] = df['msPlayed'].astype('int32')
     df['hour'] = df['endTime'].dt.hour
     df['day_of_week'] = df['endTime'].dt.day_name()
-    df['duration_minutes'] = df['msPlayed'] / 60000
+    df['duration_minutes'] = (df['msPlayed'] * (1 / 60000)).astype('float32')
     df['month'] = df['endTime'].dt.month
+    return df, skipped_files
+
+def uploads_cache_path(file_bytes_tuple):
+    """
+    Returns the parquet cache path for a set of uploads, keyed on a SHA-256 of their
+    bytes salted with CLEANED_CACHE_VERSION.
+    """
+    digest = hashlib.sha256(f"spotify-dashboard-cleaned-v{CLEANED_CACHE_VERSION}".encode())
+    for file_bytes in file_bytes_tuple:
+        digest.update(len(file_bytes).to_bytes(8, "little"))
+        digest.update(file_bytes)
+    return os.path.join(CACHE_DIR, f"{CLEANED_CACHE_PREFIX}{digest.hexdigest()}.parquet")
+
+def prune_cleaned_cache():
+    """
+    Deletes cached frames from older cache versions or older than
+    CLEANED_CACHE_MAX_AGE_SECONDS, then evicts the least recently used frames
+    until the cache fits in CLEANED_CACHE_MAX_BYTES.
+    """
+    try:
+        names = os.listdir(CACHE_DIR)
+    except OSError:
+        return
+    now = time.time()
+    entries = []
+    for name in names:
+        if not name.endswith(".parquet"):
+            continue
+        path = os.path.join(CACHE_DIR, name)
+        try:
+            stat = os.stat(path)
+            if not name.startswith(CLEANED_CACHE_PREFIX) or now - stat.st_mtime > CLEANED_CACHE_MAX_AGE_SECONDS:
+                os.remove(path)
+            else:
+                entries.append((stat.st_mtime, stat.st_size, path))
+        except OSError:
+            continue
+
+    total_bytes = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total_bytes <= CLEANED_CACHE_MAX_BYTES:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total_bytes -= size
+
+def read_cleaned_cache(path):
+    """
+    Reads a cleaned DataFrame and its skipped-file count from the parquet cache.
+    Returns None if the cache is missing or unreadable.
+    """
+    if pq is None or not os.path.exists(path):
+        return None
+    try:
+        if time.time() - os.path.getmtime(path) > CLEANED_CACHE_MAX_AGE_SECONDS:
+            return None
+        table = pq.read_table(path)
+        # Refresh the mtime so eviction drops the least recently used frames first
+        os.utime(path)
+    except Exception:
+        return None
+    skipped_files = int((table.schema.metadata or {}).get(b"skipped_files", b"0"))
+    return table.to_pandas(), skipped_files
+
+def write_cleaned_cache(path, df, skipped_files):
+    """
+    Writes a cleaned DataFrame to the parquet cache with zstd compression.
+    Failures are ignored, the cache is only an optimization.
+    """
+    if pa is None:
+        return
+    try:
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        metadata = dict(table.schema.metadata or {})
+        metadata[b"skipped_files"] = str(skipped_files).encode()
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        # Write to a unique temporary file first so a crash or a concurrent session
+        # never leaves a partial cache entry
+        fd, tmp_path = tempfile.mkstemp(dir=CACHE_DIR, prefix=CLEANED_CACHE_PREFIX, suffix=".parquet")
+        os.close(fd)
+        try:
+            pq.write_table(table.replace_schema_metadata(metadata), tmp_path, compression="zstd")
+            os.replace(tmp_path, path)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+    except Exception:
+        pass
+    prune_cleaned_cache()
+
+@st.cache_data(show_spinner=False)
+def load_and_clean(file_bytes_tuple):
+    """
+    Parses the uploaded JSON files, converts them to the old format and cleans the
+    combined DataFrame, using polars when it is installed and pandas otherwise.
+    Cached on the raw file bytes so reruns skip all parsing work, and persisted to a
+    parquet cache so identical uploads in later sessions skip it too.
+    Returns the cleaned DataFrame (or None) and the number of skipped files.
+    """
+    cache_path = uploads_cache_path(file_bytes_tuple)
+    cached = read_cleaned_cache(cache_path)
+    if cached is not None:
+        return cached
+
+    cleaned = None
+    if pl is not None:
+        try:
+            cleaned = clean_with_polars(file_bytes_tuple)
+        except Exception:
+            logger.exception("Polars loader failed, falling back to pandas")
+    if cleaned is None:
+        cleaned = clean_with_pandas(file_bytes_tuple)
+    df, skipped_files = cleaned
+    if df is None:
+        return None, skipped_files
+
+    # Categorical grouping keys hash small integer codes instead of strings
+    df['artistName'] = df['artistName'].astype('category')
+    df['trackName'] = df['trackName'].astype('category')
+    df['day_of_week'] = df['day_of_week'].astype(DAY_OF_WEEK_DTYPE)
+    write_cleaned_cache(cache_path, df, skipped_files)
+    return df, skipped_files
+
+def downsample_line_figure(fig, n_shown_samples=2000):
+    """
+    Wraps a line figure with plotly-resampler so traces longer than n_shown_samples
+    are reduced with LTTB to roughly the number of points the browser can render.
+    Short traces, or a missing plotly-resampler, return the figure unchanged.
+    """
+    if all(trace.x is None or len(trace.x) <= n_shown_samples for trace in fig.data):
+        return fig
+    try:
+        from plotly_resampler import FigureResampler
+    except ImportError:
+        return fig
+    return FigureResampler(fig, default_n_shown_samples=n_shown_samples)
+
+CONTEXT_TEMPLATE = """
+            Your Spotify listening data (data range) spans from {date_range_start} to {date_range_end}.
+            You have listened for a total of {total_hours:.2f} hours.
+            You streamed {unique_songs} unique songs and {unique_artists} unique artists.
+            Your most active hour of the day is {most_active_hour}:00.
+            The most active day of the week is {most_active_day}.
+            On average, you listen to {avg_listens_per_day:.2f} minutes per day and {avg_listens_per_month:.2f} minutes per month.
+            The month with the highest listening time is {highest_month}, and the lowest is {lowest_month}.
+            Fully played songs make up {fully_played_percentage:.2f}% of your total listening activity.
+            Your longest listening session lasted {longest_session:.2f} minutes, and the shortest lasted {shortest_session:.2f} minutes.
+            Your top artist overall is {top_artist}, and your most played song is {top_song}.
+            You have listened to {weekday_playtime:.2f} minutes on weekdays and {weekend_playtime:.2f} minutes on weekends.
+            Your top artist by month is {monthly_top_artist}.
+            Your top song by month is {monthly_top_song}.
+            You listen to {top_artist} the most during late-night hours.
+            Your top 5 artists account for {top_5_artist_playtime:.2f} minutes of your listening time.
+            Your playtime distribution is {fully_played_percentage:.2f}% fully played songs and {partially_played_percentage:.2f}% partially played songs.
+            Your average listening session duration is {avg_session_duration:.2f} minutes.
+            You have repeated songs {song_repeatability_count} times in your dataset.
+            Your listening activity has been consistent at {consistency_rate:.2f}% across the week.
+            Your listening trends have changed month-to-month with {monthly_trend_variance:.2f}% variance in playtime.
+            """
+
+@st.cache_data(show_spinner=False)
+def build_context(context_kpis):
+    """
+    Fills the LLM context template from the precomputed KPI scalars.
+    """
+    return CONTEXT_TEMPLATE.format(**context_kpis)
+
+def tokenize_context(context):
+    """
+    Tokenizes the QA context once per session and caches the token ids, character
+    offsets and word ids in st.session_state, keyed on a hash of the context.
+    """
+    context_hash = hashlib.sha256(context.encode()).hexdigest()
+    cached = st.session_state.get("context_tokens")
+    if cached is None or cached["hash"] != context_hash:
+        encoded = qa_model.tokenizer(context, add_special_tokens=False, return_offsets_mapping=True)
+        cached = {
+            "hash": context_hash,
+            "input_ids": encoded["input_ids"],
+            "offsets": encoded["offset_mapping"],
+            "word_ids": encoded.word_ids(),
+        }
+        st.session_state.context_tokens = cached
+    return cached["input_ids"], cached["offsets"], cached["word_ids"]
+
+def align_span_to_words(start_idx, end_idx, word_ids):
+    """
+    Widens a token span so it covers whole words, like the pipeline's align_to_words,
+    so answers such as "55.50" are not cut into sub-word fragments.
+    """
+    if word_ids[start_idx] is not None:
+        while start_idx > 0 and word_ids[start_idx - 1] == word_ids[start_idx]:
+            start_idx -= 1
+    if word_ids[end_idx] is not None:
+        while end_idx < len(word_ids) - 1 and word_ids[end_idx + 1] == word_ids[end_idx]:
+            end_idx += 1
+    return start_idx, end_idx
+
+def context_windows(context_len, max_context_len, doc_stride=128):
+    """
+    Splits the context tokens into windows of at most max_context_len tokens that
+    overlap by doc_stride tokens, like the pipeline's stride windows, so the end of
+    a long context stays answerable. Returns (start, end) token index pairs.
+    """
+    if max_context_len <= 0:
+        return []
+    step = max(max_context_len - min(doc_stride, max_context_len // 2), 1)
+    windows = []
+    for window_start in range(0, max(context_len, 1), step):
+        window_end = min(window_start + max_context_len, context_len)
+        windows.append((window_start, window_end))
+        if window_end == context_len:
+            break
+    return windows
+
+def run_qa_batch(questions, context, max_answer_len=15):
+    """
+    Runs the QA model on a batch of questions against the pre-tokenized context,
+    so only the questions are tokenized per call. Mirrors the pipeline's span
+    selection and returns one {'answer', 'score'} dict per question.
+    """
+    tokenizer = qa_model.tokenizer
+    context_ids, offsets, word_ids = tokenize_context(context)
+    # Never exceed the position embeddings, even if the tokenizer config has no model_max_length
+    max_len = min(tokenizer.model_max_length, qa_model.model.config.max_position_embeddings - 2)
+
+    rows = []
+    row_spans = []
+    for question_idx, question in enumerate(questions):
+        question_ids = tokenizer(question, add_special_tokens=False)["input_ids"]
+        max_context_len = max_len - len(question_ids) - tokenizer.num_special_tokens_to_add(pair=True)
+        # Locate where the context starts inside the special-token template
+        context_start = tokenizer.build_inputs_with_special_tokens(question_ids, [-1]).index(-1)
+        for window_start, window_end in context_windows(len(context_ids), max_context_len):
+            rows.append(tokenizer.build_inputs_with_special_tokens(question_ids, context_ids[window_start:window_end]))
+            row_spans.append((question_idx, context_start, window_start, window_end))
+
+    responses = [{"answer": "", "score": 0.0} for _ in questions]
+    if not rows:
+        return responses
+
+    encoded = tokenizer.pad({"input_ids": rows}, return_tensors="pt")
+    with torch.inference_mode():
+        outputs = qa_model.model(input_ids=encoded["input_ids"], attention_mask=encoded["attention_mask"])
+    start_logits = outputs.start_logits.cpu().numpy()
+    end_logits = outputs.end_logits.cpu().numpy()
+
+    for i, (question_idx, context_start, window_start, window_end) in enumerate(row_spans):
+        context_len = window_end - window_start
+        if context_len == 0:
+            continue
+        # Like the pipeline, normalize over the context tokens plus the leading CLS token
+        positions = np.r_[0, context_start:context_start + context_len]
+        start = start_logits[i, positions]
+        end = end_logits[i, positions]
+        start_probs = np.exp(start - start.max())
+        start_probs = start_probs[1:] / start_probs.sum()
+        end_probs = np.exp(end - end.max())
+        end_probs = end_probs[1:] / end_probs.sum()
+        # Only spans with start <= end and at most max_answer_len tokens are valid
+        scores = np.tril(np.triu(np.outer(start_probs, end_probs)), max_answer_len - 1)
+        start_idx, end_idx = np.unravel_index(scores.argmax(), scores.shape)
+        score = float(scores[start_idx, end_idx])
+        # Keep the best span across the question's windows
+        if score <= responses[question_idx]["score"]:
+            continue
+        start_idx, end_idx = align_span_to_words(window_start + start_idx, window_start + end_idx, word_ids)
+        responses[question_idx] = {
+            "answer": context[offsets[start_idx][0]:offsets[end_idx][1]],
+            "score": score,
+        }
+    return responses
+
+def answer_questions(questions, context):
+    """
+    Answers all queued questions against the same context in one batched pass
+    through the QA model. Returns one response string per question.
+    """
+    try:
+        responses = run_qa_batch(questions, context)
+    except Exception as e:
+        return [f"Error processing your request: {e}"] * len(questions)
+    return [
+        response['answer'] if response['score'] > 0.3 else "Sorry, I couldn't find an answer to your question."
+        for response in responses
+    ]
+
+def numba_available():
+    """
+    Returns True if numba is installed, so the numba session kernel can be used.
+    """
+    return njit is not None
+
+def _assign_sessions(ts_ns, gap_ns):
+    """
+    Streams the int64 nanosecond timestamps once and returns a session id per row,
+    starting a new session whenever the gap to the previous play exceeds gap_ns.
+    """
+    sessions = np.empty(ts_ns.shape[0], dtype=np.int64)
+    session = 0
+    if ts_ns.shape[0] > 0:
+        sessions[0] = 0
+    for i in range(1, ts_ns.shape[0]):
+        if ts_ns[i] - ts_ns[i - 1] > gap_ns:
+            session += 1
+        sessions[i] = session
+    return sessions
+
+if numba_available():
+    assign_sessions = njit(cache=True)(_assign_sessions)
+else:
+    def assign_sessions(ts_ns, gap_ns):
+        """
+        NumPy fallback for the numba session kernel.
+        """
+        sessions = np.zeros(ts_ns.shape[0], dtype=np.int64)
+        np.cumsum(np.diff(ts_ns) > gap_ns, out=sessions[1:])
+        return sessions
+
+@st.cache_data(show_spinner=False)
+def compute_kpis(df):
+    """
+    Computes the playtime groupings used across the dashboard (each grouping is
+    materialized once) along with the headline KPI scalars derived from them.
+    """
+    by_hour = df.groupby('hour')['duration_minutes'].sum()
+    # Sorted once by playtime so the top entry and the top 5 are simple slices
+    by_artist = df.groupby('artistName', observed=True, sort=False)['duration_minutes'].sum().sort_values(ascending=False, kind="stable")
+    by_song = df.groupby('trackName', observed=True, sort=False)['duration_minutes'].sum().sort_values(ascending=False, kind="stable")
+    by_month = df.groupby('month')['duration_minutes'].sum()
+    by_day = df.groupby('day_of_week', observed=True, sort=False)['duration_minutes'].sum()
+    by_date = df.groupby(df['endTime'].dt.date)['duration_minutes'].sum()
+    # Only observed (month, artist/song) pairs are materialized
+    by_month_artist = df.groupby(['month', 'artistName'], observed=True, sort=False)['duration_minutes'].sum()
+    by_month_song = df.groupby(['month', 'trackName'], observed=True, sort=False)['duration_minutes'].sum()
+    by_day_hour = df.groupby(['day_of_week', 'hour'], observed=True)['duration_minutes'].sum()
+
+    # Playtime Distribution (Fully vs Partially Played)
+    ms_played = df['msPlayed'].to_numpy()
+    fully_played = int(np.count_nonzero(ms_played >= (3 * 60 * 1000) * 0.8))  # Assuming 3 min avg song length
+
+    # Listening sessions split on gaps longer than 30 minutes
+    sessions = assign_sessions(df['endTime'].to_numpy(dtype='datetime64[ns]').view('i8'), 1800 * 10**9)
+    session_lengths = df.groupby(sessions)['duration_minutes'].sum()
+    return {
+        "by_hour": by_hour,
+        "by_artist": by_artist,
+        "by_song": by_song,
+        "by_month": by_month,
+        "by_day": by_day,
+        "by_date": by_date,
+        "heatmap_data": by_day_hour.unstack(fill_value=0),
+        "total_hours": df['duration_minutes'].sum() / 60,
+        "unique_artists": df['artistName'].nunique(),
+        "unique_songs": df['trackName'].nunique(),
+        "most_active_hour": by_hour.idxmax(),
+        "avg_listens_per_day": by_date.mean(),
+        "avg_listens_per_month": by_month.mean(),
+        "avg_listens_per_hour": by_hour.mean(),
+        "top_artist": by_artist.index[0],
+        "top_song": by_song.index[0],
+        "monthly_top_artist": by_month_artist.idxmax()[1],
+        "monthly_top_song": by_month_song.idxmax()[1],
+        "fully_played": fully_played,
+        "partially_played": ms_played.size - fully_played,
+        "fully_played_percentage": fully_played / ms_played.size * 100,
+        "date_range_start": df['endTime'].min().date(),
+        "date_range_end": df['endTime'].max().date(),
+        "longest_session": session_lengths.max(),
+        "shortest_session": session_lengths.min(),
+        "avg_session_duration": session_lengths.mean(),
+        "song_repeatability_count": len(df) - df['trackName'].nunique(dropna=False),
+    }
+
+
+
+# File Upload Section
+uploaded_files = st.file_uploader("Upload JSON File(s)", type="json", accept_multiple_files=True)
+
+# Ensure session state for the queued questions and their responses
+if "pending_questions" not in st.session_state:
+    st.session_state.pending_questions = []
+if "llm_responses" not in st.session_state:
+    st.session_state.llm_responses = []
+
+if uploaded_files:
+    df, skipped_files = load_and_clean(tuple(f.getvalue() for f in uploaded_files))
+    for _ in range(skipped_files):
+        st.error("Unknown file format. Please upload valid Spotify data files.")
+    if df is None:
+        st.error("No valid data to process. File conversion failed. Check the file formats")
+        st.stop()
 
     # KPI Calculations
-    total_hours = df['duration_minutes'].sum() / 60
-    unique_artists = df['artistName'].nunique()
-    unique_songs = df['trackName'].nunique()
-    most_active_hour = df.groupby('hour')['duration_minutes'].sum().idxmax()
-    avg_listens_per_day = df.groupby(df['endTime'].dt.date)['duration_minutes'].sum().mean()
-    avg_listens_per_month = df.groupby('month')['duration_minutes'].sum().mean()
-    avg_listens_per_hour = df.groupby('hour')['duration_minutes'].sum().mean()
-    top_artist = df.groupby('artistName')['duration_minutes'].sum().idxmax()
-    top_song = df.groupby('trackName')['duration_minutes'].sum().idxmax()
+    kpis = compute_kpis(df)
+    by_hour = kpis["by_hour"]
+    by_artist = kpis["by_artist"]
+    by_song = kpis["by_song"]
+    by_month = kpis["by_month"]
+    by_day = kpis["by_day"]
+    by_date = kpis["by_date"]
+    total_hours = kpis["total_hours"]
+    unique_artists = kpis["unique_artists"]
+    unique_songs = kpis["unique_songs"]
+    most_active_hour = kpis["most_active_hour"]
+    avg_listens_per_day = kpis["avg_listens_per_day"]
+    avg_listens_per_month = kpis["avg_listens_per_month"]
+    avg_listens_per_hour = kpis["avg_listens_per_hour"]
+    top_artist = kpis["top_artist"]
+    top_song = kpis["top_song"]
 
 
     # Display KPIs
@@ -135,103 +764,88 @@ if uploaded_files:
     col1, col2, col3 = st.columns(3)
     with col1:
         # Top 5 Artists by Playtime
-        top_artists = df.groupby('artistName')['duration_minutes'].sum().nlargest(5).reset_index()
-        fig1 = px.bar(top_artists, x='artistName', y='duration_minutes', title="Top 5 Artists by Playtime")
+        top_artists = by_artist.head(5)
+        fig1 = go.Figure(go.Bar(x=top_artists.index.to_numpy(), y=top_artists.to_numpy()))
+        fig1.update_layout(title="Top 5 Artists by Playtime", xaxis_title="artistName", yaxis_title="duration_minutes")
         st.plotly_chart(fig1,use_container_width=True)
 
     with col2:
         # Top 5 Songs by Playtime
-        top_songs = df.groupby('trackName')['duration_minutes'].sum().nlargest(5).reset_index()
-        fig2 = px.bar(top_songs, x='trackName', y='duration_minutes', title="Top 5 Songs by Playtime")
+        top_songs = by_song.head(5)
+        fig2 = go.Figure(go.Bar(x=top_songs.index.to_numpy(), y=top_songs.to_numpy()))
+        fig2.update_layout(title="Top 5 Songs by Playtime", xaxis_title="trackName", yaxis_title="duration_minutes")
         st.plotly_chart(fig2,use_container_width=True)
 
     # Second Row of Charts
     # col4, col5, col6 = st.columns(3)
     with col3:
         # Listening Trends by Hour
-        hourly_playtime = df.groupby('hour')['duration_minutes'].sum().reset_index()
-        fig3 = px.line(hourly_playtime, x='hour', y='duration_minutes', title="Listening Trends by Hour")
+        fig3 = go.Figure(go.Scatter(x=by_hour.index.to_numpy(), y=by_hour.to_numpy(), mode="lines"))
+        fig3.update_layout(title="Listening Trends by Hour", xaxis_title="hour", yaxis_title="duration_minutes")
+        fig3 = downsample_line_figure(fig3)
         st.plotly_chart(fig3,use_container_width=True)
     col4, col5, col6 = st.columns(3)
     with col4:
         # Weekly Listening Heatmap
-        active_day_hour = df.groupby(['day_of_week', 'hour'])['duration_minutes'].sum().reset_index()
-        heatmap_data = active_day_hour.pivot(index='day_of_week', columns='hour', values='duration_minutes').fillna(0)
-        fig4 = px.imshow(heatmap_data, labels=dict(x="Hour", y="Day", color="Minutes"), title="Weekly Listening Heatmap")
+        heatmap_data = kpis["heatmap_data"]
+        fig4 = go.Figure(go.Heatmap(
+            z=heatmap_data.to_numpy(),
+            x=heatmap_data.columns.to_numpy(),
+            y=heatmap_data.index.to_numpy(),
+            colorbar=dict(title="Minutes"),
+        ))
+        fig4.update_layout(title="Weekly Listening Heatmap", xaxis_title="Hour", yaxis_title="Day", yaxis_autorange="reversed")
         st.plotly_chart(fig4,use_container_width=True)
 
     # Third Row of Charts
     # col5, col6 = st.columns(2)
     with col5:
         # Monthly Playtime Trends
-        monthly_playtime = df.groupby('month')['duration_minutes'].sum()
-        fig5 = px.line(monthly_playtime, x=monthly_playtime.index, y=monthly_playtime.values, title="Monthly Playtime Trends")
+        fig5 = go.Figure(go.Scatter(x=by_month.index.to_numpy(), y=by_month.to_numpy(), mode="lines"))
+        fig5.update_layout(title="Monthly Playtime Trends", xaxis_title="month", yaxis_title="duration_minutes")
+        fig5 = downsample_line_figure(fig5)
         st.plotly_chart(fig5,use_container_width=True)
 
     with col6:
         # Playtime Distribution (Fully vs Partially Played)
-        fully_played = len(df[df['msPlayed'] >= (3 * 60 * 1000) * 0.8])  # Assuming 3 min avg song length
-        partially_played = len(df[df['msPlayed'] < (3 * 60 * 1000) * 0.8])
-        play_distribution = pd.DataFrame({
-            'Category': ['Fully Played', 'Partially Played'],
-            'Count': [fully_played, partially_played]
-        })
-        fig6 = px.pie(play_distribution, values='Count', names='Category', title="Playtime Distribution")
+        fig6 = go.Figure(go.Pie(
+            labels=['Fully Played', 'Partially Played'],
+            values=[kpis["fully_played"], kpis["partially_played"]],
+        ))
+        fig6.update_layout(title="Playtime Distribution")
         st.plotly_chart(fig6,use_container_width=True)
 
     # Calculate Metrics
-    total_hours = df['duration_minutes'].sum() / 60
-    unique_artists = df['artistName'].nunique()
-    unique_songs = df['trackName'].nunique()
-    most_active_hour = df.groupby('hour')['duration_minutes'].sum().idxmax()
-    most_active_day = df.groupby('day_of_week')['duration_minutes'].sum().idxmax()
-    date_range_start = df['endTime'].min().date()
-    date_range_end = df['endTime'].max().date()
+    most_active_day = by_day.idxmax()
+    date_range_start = kpis["date_range_start"]
+    date_range_end = kpis["date_range_end"]
 
     # Listening Trends
-    avg_listens_per_day = df.groupby(df['endTime'].dt.date)['duration_minutes'].sum().mean()
-    avg_listens_per_month = df.groupby(df['month'])['duration_minutes'].sum().mean()
-    avg_listens_per_hour = df.groupby(df['hour'])['duration_minutes'].sum().mean()
-    highest_month = df.groupby('month')['duration_minutes'].sum().idxmax()
-    lowest_month = df.groupby('month')['duration_minutes'].sum().idxmin()
+    highest_month = by_month.idxmax()
+    lowest_month = by_month.idxmin()
 
     # Comparisons
-    weekday_playtime = df[df['day_of_week'].isin(['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday'])]['duration_minutes'].sum()
-    weekend_playtime = df[df['day_of_week'].isin(['Saturday', 'Sunday'])]['duration_minutes'].sum()
+    weekday_playtime = by_day.reindex(['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday']).sum()
+    weekend_playtime = by_day.reindex(['Saturday', 'Sunday']).sum()
 
     # Playtime Distribution
-    fully_played = len(df[df['msPlayed'] >= (3 * 60 * 1000) * 0.8])
-    partially_played = len(df[df['msPlayed'] < (3 * 60 * 1000) * 0.8])
-    fully_played_percentage = fully_played / len(df) * 100
-
-    # Longest/Shortest Sessions
-    df['session'] = (df['endTime'] - df['endTime'].shift(1)).dt.total_seconds() > 1800
-    session_lengths = df.groupby(df['session'].cumsum())['duration_minutes'].sum()
-    longest_session = session_lengths.max()
-    shortest_session = session_lengths.min()
+    fully_played_percentage = kpis["fully_played_percentage"]
 
     # Top Artists and Songs
-    top_artist = df.groupby('artistName')['duration_minutes'].sum().idxmax()
-    top_song = df.groupby('trackName')['duration_minutes'].sum().idxmax()
-    
-    weekday_playtime = df[df['day_of_week'].isin(['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday'])]['duration_minutes'].sum()
-    weekend_playtime = df[df['day_of_week'].isin(['Saturday', 'Sunday'])]['duration_minutes'].sum()
+    monthly_top_artist = kpis["monthly_top_artist"]
+    monthly_top_song = kpis["monthly_top_song"]
 
-    monthly_top_artist = df.groupby(['month', 'artistName'])['duration_minutes'].sum().idxmax()[1]
-    monthly_top_song = df.groupby(['month', 'trackName'])['duration_minutes'].sum().idxmax()[1]
+    top_5_artist_playtime = by_artist.head(5).sum()
 
-    top_5_artist_playtime = df.groupby('artistName')['duration_minutes'].sum().nlargest(5).sum()
+    longest_session = kpis["longest_session"]
+    shortest_session = kpis["shortest_session"]
+    avg_session_duration = kpis["avg_session_duration"]
+    song_repeatability_count = kpis["song_repeatability_count"]
 
-    session_deltas = (df['endTime'] - df['endTime'].shift()).dt.total_seconds().fillna(0)
-    df['session'] = (session_deltas > 1800).cumsum()
-    session_lengths = df.groupby('session')['duration_minutes'].sum()
-    avg_session_duration = session_lengths.mean()
-    song_repeatability_count = df['trackName'].duplicated().sum()
-
-    monthly_trend_variance = df.groupby('month')['duration_minutes'].sum().pct_change().mean() * 100
-    consistency_rate = (len(df.groupby('day_of_week')) / 7) * 100
+    monthly_trend_variance = by_month.pct_change().mean() * 100
+    consistency_rate = (len(by_day) / 7) * 100
     # Calculate the total listening time per month
-    monthly_activity = df.groupby('month')['duration_minutes'].sum()
+    monthly_activity = by_month
 
     # Get the most active month
     most_active_month = monthly_activity.idxmax()
@@ -242,46 +856,60 @@ if uploaded_files:
 
     st.subheader("Ask a Question About Your Data")
     with st.container():
-        user_query = st.text_input("Type your question here:")
-
-        if user_query:
-            # Context for the LLM
-            context = f"""
-            Your Spotify listening data (data range) spans from {date_range_start} to {date_range_end}.
-            You have listened for a total of {total_hours:.2f} hours.
-            You streamed {unique_songs} unique songs and {unique_artists} unique artists.
-            Your most active hour of the day is {most_active_hour}:00.
-            The most active day of the week is {most_active_day}.
-            On average, you listen to {avg_listens_per_day:.2f} minutes per day and {avg_listens_per_month:.2f} minutes per month.
-            The month with the highest listening time is {highest_month}, and the lowest is {lowest_month}.
-            Fully played songs make up {fully_played_percentage:.2f}% of your total listening activity.
-            Your longest listening session lasted {longest_session:.2f} minutes, and the shortest lasted {shortest_session:.2f} minutes.
-            Your top artist overall is {top_artist}, and your most played song is {top_song}.
-            You have listened to {weekday_playtime:.2f} minutes on weekdays and {weekend_playtime:.2f} minutes on weekends.
-            Your top artist by month is {monthly_top_artist}.
-            Your top song by month is {monthly_top_song}.
-            You listen to {top_artist} the most during late-night hours.
-            Your top 5 artists account for {top_5_artist_playtime:.2f} minutes of your listening time.
-            Your playtime distribution is {fully_played_percentage:.2f}% fully played songs and {100 - fully_played_percentage:.2f}% partially played songs.
-            Your average listening session duration is {avg_session_duration:.2f} minutes.
-            You have repeated songs {song_repeatability_count} times in your dataset.
-            Your listening activity has been consistent at {consistency_rate:.2f}% across the week.
-            Your listening trends have changed month-to-month with {monthly_trend_variance:.2f}% variance in playtime.
-            """
-
-            # Generate LLM Response
-            try:
-                response = qa_model(question=user_query, context=context)
-                if response['score'] > 0.3:
-                    st.session_state.llm_response = response['answer']
-                else:
-                    st.session_state.llm_response = "Sorry, I couldn't find an answer to your question."
-            except Exception as e:
-                st.session_state.llm_response = f"Error processing your request: {e}"
-
-        # Display LLM Response
-        if st.session_state.llm_response:
-            st.markdown(f"**LLM Response:** {st.session_state.llm_response}")
+        with st.form("question_form", clear_on_submit=True):
+            user_query = st.text_input("Type your question here:")
+            ask_col, queue_col = st.columns(2)
+            ask_clicked = ask_col.form_submit_button("Ask")
+            queue_clicked = queue_col.form_submit_button("Add to Queue")
+
+        if user_query and (ask_clicked or queue_clicked):
+            st.session_state.pending_questions.append(user_query)
+
+        if ask_clicked and st.session_state.pending_questions:
+            # Context for the LLM (only built when a question is asked, and memoized on the KPIs)
+            context = build_context({
+                "date_range_start": date_range_start,
+                "date_range_end": date_range_end,
+                "total_hours": total_hours,
+                "unique_songs": unique_songs,
+                "unique_artists": unique_artists,
+                "most_active_hour": most_active_hour,
+                "most_active_day": most_active_day,
+                "avg_listens_per_day": avg_listens_per_day,
+                "avg_listens_per_month": avg_listens_per_month,
+                "highest_month": highest_month,
+                "lowest_month": lowest_month,
+                "fully_played_percentage": fully_played_percentage,
+                "partially_played_percentage": 100 - fully_played_percentage,
+                "longest_session": longest_session,
+                "shortest_session": shortest_session,
+                "top_artist": top_artist,
+                "top_song": top_song,
+                "weekday_playtime": weekday_playtime,
+                "weekend_playtime": weekend_playtime,
+                "monthly_top_artist": monthly_top_artist,
+                "monthly_top_song": monthly_top_song,
+                "top_5_artist_playtime": top_5_artist_playtime,
+                "avg_session_duration": avg_session_duration,
+                "song_repeatability_count": song_repeatability_count,
+                "consistency_rate": consistency_rate,
+                "monthly_trend_variance": monthly_trend_variance,
+            })
+
+            # Generate LLM Responses for every queued question in one batch
+            questions = st.session_state.pending_questions
+            st.session_state.llm_responses = list(zip(questions, answer_questions(questions, context)))
+            st.session_state.pending_questions = []
+
+        # Display queued questions
+        if st.session_state.pending_questions:
+            st.write("Queued questions:")
+            for question in st.session_state.pending_questions:
+                st.markdown(f"- {question}")
+
+        # Display LLM Responses
+        for question, answer in st.session_state.llm_responses:
+            st.markdown(f"**Q:** {question}  \n**LLM Response:** {answer}")
  
             
             